@@ -4,12 +4,23 @@ A Streamlit chat app using the M365 Agents SDK.
 """
 
 import asyncio
+import atexit
 import os
+import queue
+import threading
+import time
 import streamlit as st
 from streamlit_msal import Msal
 from dotenv import load_dotenv
 
-from copilot_client import CopilotStudioClient, clean_citations, format_references_html
+from copilot_client import (
+    SEARCH_IDX_RE,
+    CopilotStudioClient,
+    StreamingCitationCleaner,
+    clean_citations,
+    create_connector,
+    render_message,
+)
 
 load_dotenv()
 
@@ -28,6 +39,85 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Streaming UI throttle: flush at most every 50ms (~20 Hz) or every 16 chunks
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_CHUNKS = 16
+
+
+def shutdown_loop(loop: asyncio.AbstractEventLoop) -> None:
+    """Stop the shared event loop thread."""
+    loop.call_soon_threadsafe(loop.stop)
+
+
+@st.cache_resource
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the process-wide event loop, shared by all sessions and reused across turns.
+    It runs on a background thread; script threads submit coroutines to it.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    atexit.register(shutdown_loop, loop)
+    return loop
+
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for the result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def close_connector(loop: asyncio.AbstractEventLoop, connector) -> None:
+    """Close the shared connection pool on its event loop."""
+    asyncio.run_coroutine_threadsafe(connector.close(), loop).result()
+
+
+@st.cache_resource
+def get_connector():
+    """
+    Return the process-wide keep-alive connection pool, created on the shared loop.
+    It is closed at exit, before the loop stops.
+    """
+    connector = run_async(create_connector())
+    atexit.register(close_connector, get_loop(), connector)
+    return connector
+
+
+# Marks the end of a stream in the queue filled by stream_to_queue
+_STREAM_END = object()
+
+
+async def stream_to_queue(agen, q: queue.Queue) -> None:
+    """Forward items from an async generator into a queue, then _STREAM_END."""
+    try:
+        async for item in agen:
+            q.put(item)
+    finally:
+        q.put(_STREAM_END)
+
+
+def iterate_queued(agen, idle_timeout: float):
+    """
+    Consume an async generator on the shared event loop from the script thread.
+    Network I/O runs ahead on the loop while the script thread handles items;
+    yields None whenever no item has arrived for idle_timeout seconds.
+    """
+    q = queue.Queue()
+    fut = asyncio.run_coroutine_threadsafe(stream_to_queue(agen, q), get_loop())
+    try:
+        while True:
+            try:
+                item = q.get(timeout=idle_timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if item is _STREAM_END:
+                break
+            yield item
+        fut.result()  # Re-raise errors from the stream
+    finally:
+        # Stop the stream if iteration ends early (e.g. the script run is interrupted)
+        fut.cancel()
+
 
 def init_session():
     """Initialize session state."""
@@ -37,6 +127,18 @@ def init_session():
         st.session_state.client = None
 
 
+def render_history():
+    """Display past messages; assistant messages are rendered through the cache."""
+    for msg in st.session_state.messages:
+        with st.chat_message(msg["role"]):
+            # Use unsafe_allow_html for assistant messages (may contain citation links)
+            if msg["role"] == "assistant":
+                rendered, _ = render_message(msg["content"], msg.get("citations"))
+                st.markdown(rendered, unsafe_allow_html=True)
+            else:
+                st.markdown(msg["content"])
+
+
 def main():
     init_session()
 
@@ -72,8 +174,8 @@ def main():
     # Initialize client if needed
     if st.session_state.client is None:
         with st.spinner("Connecting to Copilot Studio..."):
-            client = CopilotStudioClient(access_token)
-            welcome = asyncio.run(client.start_conversation())
+            client = CopilotStudioClient(access_token, connector=get_connector())
+            welcome = run_async(client.start_conversation())
             st.session_state.client = client
 
             if welcome:
@@ -83,13 +185,7 @@ def main():
                 })
 
     # Display messages
-    for msg in st.session_state.messages:
-        with st.chat_message(msg["role"]):
-            # Use unsafe_allow_html for assistant messages (may contain citation links)
-            if msg["role"] == "assistant":
-                st.markdown(msg["content"], unsafe_allow_html=True)
-            else:
-                st.markdown(msg["content"])
+    render_history()
 
     # Chat input
     if prompt := st.chat_input("Message Copilot..."):
@@ -105,99 +201,114 @@ def main():
             status_placeholder = st.empty()
             content_placeholder = st.empty()
 
-            async def process_response():
-                content_parts = []
+            def process_response():
+                # Streamed deltas are appended; both are joined only on a throttled flush and once at the end
+                raw_parts = []  # Raw text with citation markers, for the final HTML pass
+                cleaned_so_far = []  # Streamed text with citations cleaned, for display
+                cleaner = StreamingCitationCleaner()
                 suggestions = None
                 citation_metadata = {}
-                search_results = []  # Collect search results by index
-                thoughts = []  # Collect chain-of-thought
+                search_by_idx = {}  # Search result index -> first result with that index
+                thinking_status = None  # Created on the first chain-of-thought event
                 got_streaming = False
-
-                async for msg_type, msg_content in st.session_state.client.send_message(prompt):
+                last_flush = time.monotonic()
+                pending = 0  # Content chunks received since the last flush
+
+                def flush_content():
+                    nonlocal last_flush, pending
+                    content_placeholder.markdown("".join(cleaned_so_far))
+                    last_flush = time.monotonic()
+                    pending = 0
+
+                # Network I/O runs on the shared loop; UI updates stay on the script thread
+                for event in iterate_queued(st.session_state.client.send_message(prompt), STREAM_FLUSH_INTERVAL):
+                    if event is None:
+                        # Stream is idle - show any content held back by the throttle
+                        if pending:
+                            flush_content()
+                        continue
+                    msg_type, msg_content = event
                     if msg_type == 'status':
                         status_placeholder.caption(f"_{msg_content}_")
                     elif msg_type == 'thought':
-                        # Collect reasoning/chain-of-thought
-                        thoughts.append(msg_content)
-                        # Update thinking display
-                        with thinking_container.status("Thinking...", expanded=False) as status:
-                            for t in thoughts:
-                                task = t.get('task', 'Processing')
-                                text = t.get('text', '')
-                                st.write(f"**{task}**: {text}")
+                        # Append reasoning/chain-of-thought to the thinking display
+                        if thinking_status is None:
+                            thinking_status = thinking_container.status("Thinking...", expanded=False)
+                        task = msg_content.get('task', 'Processing')
+                        text = msg_content.get('text', '')
+                        thinking_status.write(f"**{task}**: {text}")
                     elif msg_type == 'search_result':
                         # Collect search results (contain URLs)
-                        search_results.append(msg_content)
+                        search_by_idx.setdefault(msg_content['index'], msg_content)
                     elif msg_type == 'content':
                         got_streaming = True
-                        content_parts.append(msg_content)
-                        # Show accumulated content with citations cleaned (plain text during streaming)
-                        accumulated = "".join(content_parts)
-                        cleaned, _ = clean_citations(accumulated)
-                        content_placeholder.markdown(cleaned)
+                        raw_parts.append(msg_content)
+                        cleaned_so_far.append(cleaner.feed(msg_content))
+                        pending += 1
+                        # Show accumulated content with citations cleaned (plain text during streaming),
+                        # coalescing chunks so Streamlit isn't re-rendered on every token
+                        if (time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL
+                                or pending >= STREAM_FLUSH_CHUNKS):
+                            flush_content()
                     elif msg_type == 'final_content':
-                        # Non-streaming response - use this only if we didn't get streaming chunks
+                        # Non-streaming response - use this only if we didn't get streaming chunks.
+                        # Each final message replaces the previous one rather than being appended.
                         if not got_streaming:
-                            content_parts = [msg_content]
                             cleaned, _ = clean_citations(msg_content)
-                            content_placeholder.markdown(cleaned)
+                            raw_parts[:] = [msg_content]
+                            cleaned_so_far[:] = [cleaned]
+                            flush_content()
                     elif msg_type == 'citations':
-                        # Merge citation metadata from entities
-                        # Try to enrich with URLs from search results
-                        for cite_id, cite_info in msg_content.items():
-                            # Citation IDs are like 'turn52search0' - extract index
-                            import re
-                            match = re.search(r'search(\d+)$', cite_id)
-                            if match and not cite_info.get('url'):
-                                idx = int(match.group(1))
-                                # Find matching search result by index
-                                for sr in search_results:
-                                    if sr.get('index') == idx:
-                                        cite_info['url'] = sr.get('url', '')
-                                        if not cite_info.get('title'):
-                                            cite_info['title'] = sr.get('title', '')
-                                        break
+                        # Merge citation metadata from entities (enriched once after the stream)
                         citation_metadata.update(msg_content)
                     elif msg_type == 'suggestion':
                         suggestions = msg_content
 
+                # Enrich citations missing a URL from search results
+                for cite_id, cite_info in citation_metadata.items():
+                    # Citation IDs are like 'turn52search0' - extract index
+                    match = SEARCH_IDX_RE.search(cite_id)
+                    if match and not cite_info.get('url'):
+                        # Find matching search result by index
+                        sr = search_by_idx.get(int(match.group(1)))
+                        if sr:
+                            cite_info['url'] = sr.get('url', '')
+                            if not cite_info.get('title'):
+                                cite_info['title'] = sr.get('title', '')
+
+                # Flush the cleaner's carry and any content still buffered by the throttle
+                tail = cleaner.flush()
+                if tail:
+                    cleaned_so_far.append(tail)
+                if pending or tail:
+                    flush_content()
+
                 # Finalize thinking display
-                if thoughts:
-                    with thinking_container.status("Reasoning", expanded=False, state="complete") as status:
-                        for t in thoughts:
-                            task = t.get('task', 'Processing')
-                            text = t.get('text', '')
-                            st.write(f"**{task}**: {text}")
+                if thinking_status is not None:
+                    thinking_status.update(label="Reasoning", state="complete")
 
                 # Clear status when done
                 status_placeholder.empty()
 
-                # Return cleaned final content with clickable HTML citations
-                raw_content = "".join(content_parts)
-                cleaned_text, citations = clean_citations(raw_content, use_html=True, citation_metadata=citation_metadata)
-
-                # Add references section with clickable links
-                if citations:
-                    cleaned_text += format_references_html(citations)
+                # Return raw content; rendering (HTML citations + references) is cached per message
+                return "".join(raw_parts), citation_metadata, suggestions
 
-                return cleaned_text, citations, suggestions
-
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                response, citations, suggestions = loop.run_until_complete(process_response())
-            finally:
-                loop.close()
+            raw_response, citation_metadata, suggestions = process_response()
 
-            # Render final response (with clickable HTML citations if any)
+            # Render final response (with clickable HTML citations and references if any)
+            response, _ = render_message(raw_response, citation_metadata)
             content_placeholder.markdown(response, unsafe_allow_html=True)
 
             # Show suggestions if any
             if suggestions:
                 st.caption(f"**Suggestions:** {suggestions}")
 
-        # Store response with HTML citations for history
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        # Store the raw response and citation metadata; history re-renders through the cache
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": raw_response,
+            "citations": citation_metadata,
+        })
 
 
 if __name__ == "__main__":
@@ -3,15 +3,40 @@ Copilot Studio Client
 Simple wrapper for the M365 Agents SDK.
 """
 
+import asyncio
+import functools
+import json
 import os
 import re
 from typing import AsyncIterator, Optional
 
+import aiohttp
 from microsoft_agents.activity import ActivityTypes
 from microsoft_agents.copilotstudio.client import ConnectionSettings, CopilotClient
 
+try:
+    import orjson  # Optional: faster serialization for the debug activity dump
+except ImportError:
+    orjson = None
 
-def clean_citations(text: str, use_html: bool = False, citation_metadata: dict = None) -> tuple[str, dict]:
+# Longest citation marker (\ue200cite\ue202{id}\ue201) expected to be split across stream chunks
+MAX_MARKER_LEN = 64
+
+# Pattern: \ue200cite\ue202{citation_id}\ue201 (using non-greedy match)
+_CITATION_RE = re.compile('\ue200cite\ue202(.+?)\ue201', re.DOTALL)
+# Citation IDs are like 'turn52search0' - the trailing number indexes search results
+SEARCH_IDX_RE = re.compile(r'search(\d+)$')
+# Entity keys that may carry a citation's URL, in priority order
+_URL_KEYS = ('url', 'Url', 'uri', 'sameAs')
+
+# Activity dump written when COPILOT_DEBUG is set (one JSON object per line)
+DEBUG_ACTIVITIES_PATH = '/tmp/activities_debug.jsonl'
+
+# Shared read-only stand-in for missing citation metadata (never mutated), avoiding a new dict per call
+_EMPTY: dict = {}
+
+
+def clean_citations(text: str, use_html: bool = False, citation_metadata: Optional[dict] = None) -> tuple[str, dict]:
     """
     Clean up citation markers from Copilot Studio responses.
     Citations use Unicode markers: \ue200cite\ue202{id}\ue201
@@ -27,27 +52,34 @@ def clean_citations(text: str, use_html: bool = False, citation_metadata: dict =
     if not text:
         return text, {}
 
-    citation_metadata = citation_metadata or {}
+    # Fast path: most streamed text has no citation markers
+    if '\ue200' not in text:
+        return text, {}
+
+    if citation_metadata is None:
+        citation_metadata = _EMPTY
 
-    # Track unique citations to number them
-    citations = {}
-    citation_counter = [0]
+    # Track unique citations to number them, building the result dict in the same pass
+    citation_nums = {}
+    citations_by_num = {}
+    citation_counter = 0
 
     def replace_citation(match):
+        nonlocal citation_counter
         citation_id = match.group(1)
-        if citation_id not in citations:
-            citation_counter[0] += 1
-            num = citation_counter[0]
-            meta = citation_metadata.get(citation_id, {})
-            citations[citation_id] = {
-                'num': num,
+        num = citation_nums.get(citation_id)
+        if num is None:
+            citation_counter += 1
+            num = citation_counter
+            meta = citation_metadata.get(citation_id, _EMPTY)
+            citation_nums[citation_id] = num
+            citations_by_num[num] = {
+                'id': citation_id,
                 'url': meta.get('url', ''),
                 'title': meta.get('title', f'Source {num}')
             }
 
-        cite_info = citations[citation_id]
-        num = cite_info['num']
-        url = cite_info['url']
+        url = citations_by_num[num]['url']
 
         if use_html and url:
             # Clickable superscript that opens external URL
@@ -56,49 +88,150 @@ def clean_citations(text: str, use_html: bool = False, citation_metadata: dict =
             # Plain text for streaming display
             return f"[{num}]"
 
-    # Pattern: \ue200cite\ue202{citation_id}\ue201 (using non-greedy match)
-    cleaned = re.sub(r'\ue200cite\ue202(.+?)\ue201', replace_citation, text)
-
-    # Return dict mapping numbers to citation info
-    citations_by_num = {v['num']: {'id': k, 'url': v['url'], 'title': v['title']}
-                        for k, v in citations.items()}
+    cleaned = _CITATION_RE.sub(replace_citation, text)
 
     return cleaned, citations_by_num
 
 
+def _entity_to_dict(ent) -> Optional[dict]:
+    """Normalize an activity entity (dict or SDK object) to a dict, or None."""
+    return ent if isinstance(ent, dict) else (vars(ent) if hasattr(ent, '__dict__') else None)
+
+
+def _append_debug_activity(activity_debug: dict) -> None:
+    """Serialize an activity and append it as one line to the debug dump."""
+    if orjson is not None:
+        line = orjson.dumps(activity_debug, default=str,
+                            option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    else:
+        line = (json.dumps(activity_debug, default=str) + "\n").encode()
+    with open(DEBUG_ACTIVITIES_PATH, 'ab') as f:
+        f.write(line)
+
+
+class StreamingCitationCleaner:
+    """
+    Incrementally clean citation markers from streamed content deltas.
+
+    Only each new delta is scanned, so cleaning stays O(delta) per chunk.
+    Numbering matches clean_citations() on the full text, and a marker split
+    across chunks is held back until it completes.
+    """
+
+    def __init__(self):
+        self._numbers = {}
+        self._carry = ""
+
+    def _replace_citation(self, match):
+        num = self._numbers.setdefault(match.group(1), len(self._numbers) + 1)
+        return f"[{num}]"
+
+    def feed(self, delta: str) -> str:
+        """Clean a content delta and return the text that is safe to display."""
+        buf = self._carry + delta
+        self._carry = ""
+        start = buf.rfind('\ue200')
+        if start == -1:
+            # Fast path: no citation markers in this delta
+            return buf
+        # Hold back a trailing marker that hasn't been closed yet
+        if '\ue201' not in buf[start:] and len(buf) - start < MAX_MARKER_LEN:
+            buf, self._carry = buf[:start], buf[start:]
+        return _CITATION_RE.sub(self._replace_citation, buf)
+
+    def flush(self) -> str:
+        """Return any held-back text at the end of the stream."""
+        buf, self._carry = self._carry, ""
+        return _CITATION_RE.sub(self._replace_citation, buf)
+
+
 def format_references_html(citations: dict) -> str:
     """Format citations as an HTML references section with clickable links."""
     if not citations:
         return ""
 
-    html = '<div style="margin-top:1rem;padding-top:0.5rem;border-top:1px solid #ddd;font-size:0.9em;">'
-    html += '<strong>References:</strong><br>'
-    for num in sorted(citations.keys()):
+    parts = [
+        '<div style="margin-top:1rem;padding-top:0.5rem;border-top:1px solid #ddd;font-size:0.9em;">',
+        '<strong>References:</strong><br>',
+    ]
+    nums = sorted(citations)
+    for num in nums:
         cite = citations[num]
         title = cite.get('title', f'Source {num}')
         url = cite.get('url', '')
         if url:
-            html += f'<a href="{url}" target="_blank" style="color:#0066cc;">[{num}] {title}</a><br>'
+            parts.append(f'<a href="{url}" target="_blank" style="color:#0066cc;">[{num}] {title}</a><br>')
         else:
-            html += f'<span>[{num}] {title}</span><br>'
-    html += '</div>'
-    return html
+            parts.append(f'<span>[{num}] {title}</span><br>')
+    parts.append('</div>')
+    return ''.join(parts)
+
+
+@functools.lru_cache(maxsize=256)
+def _render_cached(raw: str, use_html: bool, citation_items: tuple) -> tuple[str, tuple]:
+    """Memoized clean_citations + references section, keyed by raw content."""
+    citation_metadata = {cite_id: dict(info) for cite_id, info in citation_items}
+    cleaned, citations = clean_citations(raw, use_html=use_html, citation_metadata=citation_metadata)
+    if use_html and citations:
+        cleaned += format_references_html(citations)
+    return cleaned, tuple(citations.items())
+
+
+def render_message(raw: str, citation_metadata: Optional[dict] = None, use_html: bool = True) -> tuple[str, dict]:
+    """
+    Render a raw assistant response for display, caching the result.
+
+    Args:
+        raw: The response text containing citation markers
+        citation_metadata: Dict mapping citation IDs to {url, title}
+        use_html: If True, render clickable citations and a references section
+
+    Returns:
+        tuple: (rendered_text, citations_dict) as returned by clean_citations
+    """
+    if citation_metadata is None:
+        citation_metadata = _EMPTY
+
+    # Flatten metadata to a hashable cache key; values are rendered via str() anyway
+    citation_items = tuple(sorted(
+        (cite_id, tuple(sorted((key, str(value)) for key, value in info.items())))
+        for cite_id, info in citation_metadata.items()
+    ))
+    rendered, citations = _render_cached(raw, use_html, citation_items)
+    return rendered, dict(citations)
+
+
+async def create_connector() -> aiohttp.TCPConnector:
+    """
+    Create a keep-alive connection pool to share across SDK requests.
+    Must be awaited on the event loop that will run those requests.
+    """
+    return aiohttp.TCPConnector(limit=100, keepalive_timeout=75)
 
 
 class CopilotStudioClient:
     """Wrapper for Copilot Studio interactions."""
 
-    def __init__(self, access_token: str):
-        """Initialize with an access token from MSAL."""
+    def __init__(self, access_token: str, connector: Optional[aiohttp.TCPConnector] = None):
+        """
+        Initialize with an access token from MSAL.
+
+        The SDK opens an aiohttp session per request; passing a shared connector
+        (see create_connector) keeps its connections alive across messages.
+        """
         self.settings = ConnectionSettings(
             environment_id=os.getenv("COPILOT_ENVIRONMENT_ID", ""),
             agent_identifier=os.getenv("COPILOT_AGENT_IDENTIFIER", ""),
             cloud=None,
             copilot_agent_type=None,
             custom_power_platform_cloud=None,
+            # Don't let each per-request session close the shared pool
+            client_session_settings={'connector': connector, 'connector_owner': False} if connector else None,
         )
         self._client = CopilotClient(self.settings, access_token)
         self._conversation_id: Optional[str] = None
+        # Activity debug dump is opt-in and kept off the streaming hot path
+        self._debug = bool(os.getenv("COPILOT_DEBUG"))
 
     async def start_conversation(self) -> Optional[str]:
         """Start a new conversation and return welcome message."""
@@ -126,34 +259,27 @@ class CopilotStudioClient:
             yield ('content', "Error: No active conversation.")
             return
 
-        import json
-        debug_activities = []
-
         async for reply in self._client.ask_question(message, self._conversation_id):
             channel_data = getattr(reply, 'channel_data', None) or getattr(reply, 'channelData', {}) or {}
 
-            # Capture full activity for debugging - properly serialize entities
-            entities_data = []
-            raw_entities = getattr(reply, 'entities', None) or []
-            for ent in raw_entities:
-                if hasattr(ent, '__dict__'):
-                    entities_data.append(vars(ent))
-                elif isinstance(ent, dict):
-                    entities_data.append(ent)
-                else:
-                    entities_data.append(str(ent))
-
-            activity_debug = {
-                'type': str(reply.type),
-                'text': reply.text[:200] if reply.text else None,
-                'channel_data': channel_data,
-                'entities': entities_data,
-                'attachments': getattr(reply, 'attachments', None),
-                'value': getattr(reply, 'value', None),
-            }
-            debug_activities.append(activity_debug)
-            with open('/tmp/activities_debug.json', 'w') as f:
-                json.dump(debug_activities, f, indent=2, default=str)
+            # Normalize entities once; only the debug dump and message replies use them
+            ent_dicts = []
+            if self._debug or reply.type == ActivityTypes.message:
+                raw_entities = getattr(reply, 'entities', None) or []
+                ent_dicts = [d for d in (_entity_to_dict(e) for e in raw_entities) if d is not None]
+
+            if self._debug:
+                # Capture full activity for debugging
+                activity_debug = {
+                    'type': str(reply.type),
+                    'text': reply.text[:200] if reply.text else None,
+                    'channel_data': channel_data,
+                    'entities': ent_dicts,
+                    'attachments': getattr(reply, 'attachments', None),
+                    'value': getattr(reply, 'value', None),
+                }
+                # Append only this activity, serialized and written off the event loop
+                await asyncio.to_thread(_append_debug_activity, activity_debug)
 
             # Capture chain-of-thought and search results from event activities
             if reply.type == ActivityTypes.event:
@@ -167,12 +293,9 @@ class CopilotStudioClient:
                         # Extract just the tool name from identifiers like:
                         # MCcr981_guildhallAssistant.action.GuildhallMCPServer-InvokeServer:list_quests
                         # P:UniversalSearchTool
-                        task_name = task_id
-                        if ':' in task_id:
-                            task_name = task_id.split(':')[-1]  # Get part after last colon
-                        elif '.' in task_id:
-                            task_name = task_id.split('.')[-1]  # Get part after last dot
-                        task_name = task_name.replace('P:', '').replace('-InvokeServer', '')
+                        # Part after the last colon, else after the last dot (this also drops 'P:')
+                        sep = ':' if ':' in task_id else '.'
+                        task_name = task_id.rpartition(sep)[2].removesuffix('-InvokeServer')
                         yield ('thought', {
                             'text': thought,
                             'task': task_name,
@@ -210,25 +333,17 @@ class CopilotStudioClient:
 
             elif reply.type == ActivityTypes.message:
                 # Extract citation metadata from entities (schema.org Claim objects)
-                entities = getattr(reply, 'entities', None) or []
                 citation_map = {}
-                for ent in entities:
-                    # Handle both dict and object forms
-                    if hasattr(ent, '__dict__'):
-                        ent_dict = vars(ent)
-                    elif isinstance(ent, dict):
-                        ent_dict = ent
-                    else:
-                        continue
-
+                for ent_dict in ent_dicts:
                     # Look for schema.org Claim type entities with citation data
-                    ent_type = ent_dict.get('type', '')
-                    if 'Claim' in str(ent_type) or 'citation' in str(ent_type).lower():
+                    ent_type_lc = str(ent_dict.get('type', '')).lower()
+                    if 'claim' in ent_type_lc or 'citation' in ent_type_lc:
                         cite_id = ent_dict.get('@id') or ent_dict.get('id') or ''
                         if cite_id:
+                            # Coerce to str: schema.org values may be arrays (e.g. sameAs)
                             citation_map[cite_id] = {
-                                'url': ent_dict.get('url') or ent_dict.get('Url') or ent_dict.get('uri') or ent_dict.get('sameAs') or '',
-                                'title': ent_dict.get('name') or ent_dict.get('title') or ent_dict.get('Name') or ''
+                                'url': str(next((ent_dict[k] for k in _URL_KEYS if ent_dict.get(k)), '')),
+                                'title': str(ent_dict.get('name') or ent_dict.get('title') or ent_dict.get('Name') or '')
                             }
 
                 if citation_map: